@@ -5,10 +5,22 @@ https://github.com/leifdenby/namelist_python
 """
 from __future__ import print_function, absolute_import
 from collections import OrderedDict as odict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import os
 import re
-from itertools import groupby
 from runner.filetype import FileType
 
+# compiled once at import, reused by every parse_nml call
+_GROUP_RE = re.compile(r'&([^&]+)/', re.DOTALL)  # allow blocks to span multiple lines
+_ARRAY_RE = re.compile(r'(\w+)\((\d+)\)')
+# _STRING_RE = re.compile(r"\'\s*\w[^']*\'")
+_STRING_RE = re.compile(r"[\'\"]*[\'\"]")
+# _COMPLEX_RE = re.compile(r'^\((\d+.?\d*),(\d+.?\d*)\)$')
+_NUMERIC_START = frozenset("+-0123456789")  # not ".": mostly .true./.false.
+_BOOL_MAP = {'.true.': True, 't': True, 'true': True,
+             '.false.': False, 'f': False, 'false': False}
+
 class ParamNml(object):
     def __init__(self, group, name, value, help=None):
         self.group = group
@@ -24,131 +36,136 @@ class Namelist(FileType):
         self.sep = sep
 
     def dumps(self, params):
-        pars = []
+        groups = odict()
         for longname,value in params.items():
             group, name = longname.split(self.sep)
-            pars.append(ParamNml(group, name, value))
-        return format_nml(pars)
+            groups.setdefault(group, []).append((name, value, None))
+        return _format_groups(groups)
 
     def loads(self, string):
         params = parse_nml(string)
         return odict([(p.group + self.sep + p.name, p.value) for p in params])
 
+    def loads_keys(self, string):
+        """parameter names only, skipping the (costly) value parsing
+        """
+        return [group + self.sep + name for group, name in parse_nml_keys(string)]
+
+    def load_keys(self, f):
+        return self.loads_keys(f.read())
+
 def parse_nml(string, ignore_comments=False):
     """ parse a string namelist, and returns a list of param bundles
     with four attrs: name, value, help, group
     """
-    group_re = re.compile(r'&([^&]+)/', re.DOTALL)  # allow blocks to span multiple lines
-    array_re = re.compile(r'(\w+)\((\d+)\)')
-    # string_re = re.compile(r"\'\s*\w[^']*\'")
-    string_re = re.compile(r"[\'\"]*[\'\"]")
-    # self._complex_re = re.compile(r'^\((\d+.?\d*),(\d+.?\d*)\)$')
-
     # list of parameters
     params = []
-    # groups = odict()
 
-    filtered_lines = []
-    for line in string.split('\n'):
-        line = line.strip()
-        if line == "":
-            continue
-        # remove comments, since they may have forward-slashes
-        # set ignore_comments to True is you want to keep them.
-        if line.startswith('!'):
-            continue  
-        if ignore_comments and '!' in line:
-            line = line[:line.index('!')]
+    for group_name, line in _iter_group_lines(string, ignore_comments):
+        name, value, comment = _parse_line(line)
+        params.append(ParamNml(group_name, name, value, help=comment))
+
+    return params
 
-        filtered_lines.append(line)
+def parse_nml_keys(string):
+    """ parse a string namelist, and returns a list of (group, name) pairs,
+    without parsing the values
+    """
+    return [(group_name, line.split('=')[0].strip())
+            for group_name, line in _iter_group_lines(string, ignore_comments=True)]
 
-    group_blocks = re.findall(group_re, "\n".join(filtered_lines))
+def _iter_group_lines(string, ignore_comments=False):
+    """ iterate over (group name, logical line) in a string namelist
+    """
+    # remove blank lines and comments, since they may have forward-slashes
+    # set ignore_comments to True to also strip end-of-line comments
+    # (otherwise they are kept as param help)
+    filtered_lines = [line for line in map(str.strip, string.split('\n'))
+                      if line and not line.startswith('!')]
+    if ignore_comments:
+        filtered_lines = [line.partition('!')[0] for line in filtered_lines]
 
-    for i, group_block in enumerate(group_blocks):
+    group_blocks = _GROUP_RE.findall("\n".join(filtered_lines))
+
+    for group_block in group_blocks:
         group_lines = group_block.split('\n')
         group_name = group_lines.pop(0).strip()
         # check for comments
         if "!" in group_name:
             i = group_name.index("!")
             group_name = group_name[:i].strip()
-            group_help = group_name[i+1:].strip()
 
         # some lines are continuation of previous lines: filter
-        joined_lines = []
+        joined_lines = []  # list of lists (fragments of one logical line)
         for line in group_lines:
             line = line.strip()
             if '=' in line:
-                joined_lines.append(line)
+                joined_lines.append([line])
             elif line == '':
                 pass
             else:
                 # continuation of previous line
-                joined_lines[-1] += line
-        group_lines = joined_lines
+                joined_lines[-1].append(line)
 
-        for line in group_lines:
-            name, value, comment = _parse_line(line)
-
-            param = ParamNml(group_name, name, value, help=comment)
-
-            # group[variable_name] = parsed_value
-            params.append(param)
-
-        # groups[group_name] = group
-    return params
+        for parts in joined_lines:
+            yield group_name, ''.join(parts)
 
 def _parse_line(line):
     "parse a line within a block"
     # commas at the end of lines seem to be optional
-    comment = ""
-    if '!' in line:
-        sep = line.index("!")
-        comment = line[sep+1:].strip()
-        line = line[:sep].strip()
+    line, _, comment = line.partition('!')
+    line = line.rstrip()
 
     if line.endswith(','):
         line = line[:-1]
 
-    k, v = line.split('=')
-    name = k.strip()
-    value = _parse_value(v.strip())
-    return name, value, comment
+    k, _, v = line.partition('=')
+    return k.strip(), _parse_value(v.strip()), comment.strip()
 
 def _parse_value(variable_value):
     """
     Tries to parse a single value, raises an exception if no single value is matched
     """
-    try:
-        parsed_value = int(variable_value)
-    except ValueError:
+    # fast path for the common numeric case (comma: array, do not even try)
+    if variable_value[:1] in _NUMERIC_START and "," not in variable_value:
         try:
-            parsed_value = float(variable_value)
+            return int(variable_value)
         except ValueError:
-            if variable_value.lower() in ['.true.', 't', 'true']:
-                # boolean
-                parsed_value = True
-            elif variable_value.lower() in ['.false.', 'f', 'false']:
-                parsed_value = False
-            elif variable_value.startswith("'") \
-                and variable_value.endswith("'") \
-                and variable_value.count("'") == 2 \
-            or variable_value.startswith('"') \
-                and variable_value.endswith('"') \
-                and variable_value.count('"') == 2:
-                parsed_value = variable_value[1:-1]
-            elif variable_value.startswith("/") and variable_value.endswith("/"):
-                # array /3,4,5/
-                parsed_value = _parse_array(variable_value[1:-1].split(','))
-            elif "," in variable_value:
-                # array 3, 4, 5
-                parsed_value = _parse_array(variable_value.split(','))
-            elif '*' in variable_value:
-                # 3*4  means [4, 4, 4, 4] ==> this is handled in _parse_array
-                parsed_value = _parse_array([variable_value])
-            elif len(variable_value.split()) > 1:
-                # array 3 4 5
-                parsed_value = _parse_array(variable_value.split())
-            else:
+            try:
+                return float(variable_value)
+            except ValueError:
+                pass
+
+    boolean = _BOOL_MAP.get(variable_value.lower())
+    if boolean is not None:
+        parsed_value = boolean
+    elif variable_value.startswith("'") \
+        and variable_value.endswith("'") \
+        and variable_value.count("'") == 2 \
+    or variable_value.startswith('"') \
+        and variable_value.endswith('"') \
+        and variable_value.count('"') == 2:
+        parsed_value = variable_value[1:-1]
+    elif variable_value.startswith("/") and variable_value.endswith("/"):
+        # array /3,4,5/
+        parsed_value = _parse_array(variable_value[1:-1].split(','))
+    elif "," in variable_value:
+        # array 3, 4, 5
+        parsed_value = _parse_array(variable_value.split(','))
+    elif '*' in variable_value:
+        # 3*4  means [4, 4, 4, 4] ==> this is handled in _parse_array
+        parsed_value = _parse_array([variable_value])
+    elif len(variable_value.split()) > 1:
+        # array 3 4 5
+        parsed_value = _parse_array(variable_value.split())
+    else:
+        # less common numeric spellings, e.g. nan or inf
+        try:
+            parsed_value = int(variable_value)
+        except ValueError:
+            try:
+                parsed_value = float(variable_value)
+            except ValueError:
                 print("Parsing ERROR: >>>{}<<<".format(variable_value))
                 raise ValueError(variable_value)
     return parsed_value
@@ -165,39 +182,58 @@ def _parse_array(values):
             mult, val = v.split('*')
             parsed_value.extend(int(mult) * [ _parse_value(val.strip())  ])
         else:
-            parsed_value.append(_parse_value(v))
+            parsed_value.append(_parse_value(v.strip()))
     return parsed_value
 
 def format_nml(params):
     """ format a flat parameter list to be written in the namelist
     """
+    groups = odict()
+    for p in params:
+        groups.setdefault(p.group, []).append((p.name, p.value, p.help))
+    return _format_groups(groups)
+
+def _format_groups(groups):
+    """ format {group: [(name, value, help), ...]} to be written in the namelist
+    """
     lines = []
-    for group_name, group_params in groupby(params, lambda x: x.group):
+    for group_name, group_params in groups.items():
         if group_name == "":
-            print(list(group_params))
-            raise ValueError("Group not defined. Cannot write to namelist.")
+            bad = [name for name, value, help in group_params]
+            raise ValueError("Group not defined for params: {}. Cannot write to namelist.".format(bad))
         lines.append("&{}".format(group_name))
-        for param in group_params:
-            if isinstance(param.value, list):
-                nmstr = "{:15}".format(param.name)
-                line = " {} = {}".format(nmstr, " ".join([_format_value(v) for v in param.value]))
+        for name, value, help in group_params:
+            if isinstance(value, list):
+                valstr = " ".join(map(_format_value, value))
             else:
-                nmstr = "{:15}".format(param.name)
-                line = " {} = {}".format(nmstr, _format_value(param.value))
-            line = "{:30}".format(line)
-            if param.help:
-                line += ' ! '+param.help
+                valstr = _format_value(value)
+            line = "{:30}".format(" {:15} = {}".format(name, valstr))
+            if help:
+                line = "{} ! {}".format(line, help)
             lines.append(line)
         lines.append("/")
     return "\n".join(lines) + "\n"
 
+def _format_str(value):
+    # no escaping in fortran strings: just pick a quote that is not used
+    quote = '"' if "'" in value else "'"
+    return quote + value + quote
+
+_FORMATTERS = {
+    bool: lambda value: value and '.true.' or '.false.',
+    int: str,
+    float: repr,
+    str: _format_str,
+}
+
 def _format_value(value):
     """ Format a value into fortran's namelist format (return a string)
     """
-    if isinstance(value, bool):
-        return value and '.true.' or '.false.'
-    else:
-        return "{}".format(repr(value))
+    formatter = _FORMATTERS.get(type(value))
+    if formatter is None and getattr(value, 'ndim', None) == 0:
+        value = value.item()  # numpy scalar, e.g. from XParams
+        formatter = _FORMATTERS.get(type(value))
+    return (formatter or repr)(value)
 
 ## Methods added by Alex for extra functionality:
 ## (not clear if this is the best place for them...)
@@ -217,6 +253,8 @@ def param_summary(par,rundir,verbose):
     print("rundir : {}".format(rundir))
 
     if verbose:
+        from pandas import DataFrame
+
         # Print parameters specified for this run
 
         out_list_head = ["Parameter","Value"]
@@ -229,10 +267,42 @@ def param_summary(par,rundir,verbose):
 
     return 
 
-def param_write_to_files(params,nml_src_paths,nml_dst_paths,grp_aliases=None):
+_NML_CACHE = {}  # parsed namelist files: {abspath: ((mtime, size), params)}
+
+def _file_key(path):
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size)
+
+def _load_nml_cached(path):
+    '''Load a namelist parameter file, parsing it only once as long
+    as it is not modified. Return a copy that the caller may update.
+    '''
+    path = os.path.abspath(path)
+    key = _file_key(path)
+    cached = _NML_CACHE.get(path)
+    if cached is None or cached[0] != key:
+        with open(path) as f:
+            cached = (key, Namelist().load(f))
+        _NML_CACHE[path] = cached
+    return odict((name, list(value) if isinstance(value, list) else value)
+                 for name, value in cached[1].items())
+
+def _load_nml_keys(path):
+    '''Parameter names of a namelist file, from the cache if available
+    '''
+    cached = _NML_CACHE.get(os.path.abspath(path))
+    if cached is not None and cached[0] == _file_key(path):
+        return list(cached[1])
+    with open(path) as f:
+        return Namelist().load_keys(f)
+
+def param_write_to_files(params,nml_src_paths,nml_dst_paths,grp_aliases=None,max_workers=None):
     '''Write parameters from a dict to one or more destination
     parameter files, given the input parameter file(s), substituting
     group names by their aliases when necessary. 
+
+    With max_workers > 1 the files are written from a process pool
+    (not possible from within daemonic workers, e.g. XRun.run).
     '''
 
     # First expand input parameter group-name aliases if available
@@ -245,8 +315,12 @@ def param_write_to_files(params,nml_src_paths,nml_dst_paths,grp_aliases=None):
     param_check_all(params_mapped,nml_src_paths)
 
     # If everything was ok, loop over files and write new parameter values 
-    for par_src_path,par_dst_path in zip(nml_src_paths,nml_dst_paths):
-        param_write_to_file(params_mapped,par_src_path,par_dst_path)
+    if max_workers is not None and max_workers > 1 and len(nml_src_paths) > 1:
+        with ProcessPoolExecutor(max_workers=min(max_workers, len(nml_src_paths))) as ex:
+            list(ex.map(param_write_to_file, repeat(params_mapped), nml_src_paths, nml_dst_paths))
+    else:
+        for par_src_path,par_dst_path in zip(nml_src_paths,nml_dst_paths):
+            param_write_to_file(params_mapped,par_src_path,par_dst_path)
 
     return 
 
@@ -255,17 +329,11 @@ def param_check_all(params,par_paths):
     exist in one or more input namelist parameter files. 
     '''
 
-    # Get all possible parameters from input files
-    params_all = []
-    for path in par_paths:
-        # Load input namelist parameters
-        params_all.append(Namelist().load(open(path)))
-
-    # Extract set of keys from all files
-    all_keys = set(k for d in params_all for k in d)
+    # Get all possible parameter names from input files
+    all_keys = set().union(*[_load_nml_keys(path) for path in par_paths])
 
     # Determine which keys do not exist in parameter file params
-    missing_keys = set(params)-set(all_keys)
+    missing_keys = params.keys() - all_keys
 
     if len(missing_keys) > 0:
         error_msg = ("\n\nError: one or more parameters not found in input parameter files.\n\n" +
@@ -282,7 +350,7 @@ def param_write_to_file(params,par_src_path,par_dst_path):
     '''
 
     # Load input namelist parameters
-    params_now = Namelist().load(open(par_src_path))
+    params_now = _load_nml_cached(par_src_path)
 
     # Update parameters with desired values (only update 
     # parameter values if the parameters are defined in this set)
@@ -290,8 +358,8 @@ def param_write_to_file(params,par_src_path,par_dst_path):
     #params_now.update(params)
 
     # Write updated parameter file to rundir
-    f = open(par_dst_path, 'w')
-    Namelist().dump(params_now, f)
+    with open(par_dst_path, 'w') as f:
+        Namelist().dump(params_now, f)
 
     return 
 
@@ -304,18 +372,10 @@ def param_map_groups(params,grp_aliases):
     params_out = dict() 
 
     for key,val in params.items():
-        if '.' in key:
-            tmp = key.split('.')
-            grp = tmp[0]
-            par = tmp[1] 
-
-            if grp in [*grp_aliases]:
-                grp_new = grp_aliases[grp]
-            else:
-                grp_new = grp 
-
-            key_new = "{}.{}".format(grp_new,par)
+        grp, sep, par = key.partition('.')
 
+        if sep and grp in grp_aliases:
+            key_new = grp_aliases[grp] + sep + par
         else:
             key_new = key 
 
@@ -46,7 +46,8 @@ class TemplateFile(FileType):
     """
     def __init__(self, template_file):
         self.template_file = template_file
-        self._template = open(template_file).read()
+        with open(template_file) as f:
+            self._template = f.read()
 
     def dumps(self, params):
         return self._template.format(**params)
@@ -3,18 +3,9 @@
 """
 from __future__ import print_function, absolute_import, division
 import argparse
-import logging
-import numpy as np
-import json
-import copy
-import shutil
 import os
-import sys
-import subprocess
-from collections import OrderedDict as odict
-from runner.tools import norm
 
-from runner.param import ScipyParam
+from runner.param import ScipyParam, Param
 from runner.model import Model
 from runner.xrun import XRun, XData
 from runner.job.config import Job
@@ -133,6 +133,8 @@ grp.add_argument('--echo', action='store_true',
 #                 help='submit using sbatch --array (faster!), EXPERIMENTAL)')
 grp.add_argument('-f', '--force', action='store_true', 
                  help='perform run even if params.txt already exists directory')
+grp.add_argument('--write-pre-run', action='store_true', 
+                 help='write runner.json (status "running") before each model starts, so that it exists even if the run is killed (e.g. timeout)')
 
 folders = argparse.ArgumentParser(add_help=False)
 grp = folders.add_argument_group("simulation settings")
@@ -248,7 +250,7 @@ def main(o):
             info_list = []
 
         for i in indices:
-            xrun[i].run(background=False)
+            xrun[i].run(background=False, write_pre_run=o.write_pre_run)
 
             if gen_info:
                 # Add runid and rundir to list for writing 
@@ -265,7 +267,7 @@ def main(o):
             
     # the default
     else:
-        xrun.run(indices=indices)
+        xrun.run(indices=indices, write_pre_run=o.write_pre_run)
 
     return
 
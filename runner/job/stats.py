@@ -121,10 +121,10 @@ grp.add_argument('-o', '--out', help="output parameter file (print to scree othe
 
 
 def resample_post(o):
-    weights = np.loadtxt(o.weights_file)
+    weights = np.loadtxt(o.weights_file, dtype=np.float64)
     if o.log:
-        weights = np.exp(weights)
-    if np.all(weights == 0):
+        np.exp(weights, out=weights)
+    if not weights.any():
         raise ValueError("all weights are zero")
     xpin = XParams.read(o.params_file)
     xparams = xpin.resample(weights, size=o.size, seed=o.seed,
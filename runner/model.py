@@ -1,12 +1,18 @@
 from __future__ import print_function, absolute_import
 import subprocess
+import shlex
+import stat
+import asyncio
+import inspect
 import os
 import logging
+import mmap
 import sys
-import json, pickle
-import datetime
-from collections import OrderedDict as odict, namedtuple
-import six
+import json
+from collections import namedtuple
+from contextlib import contextmanager
+from importlib import import_module
+from string import Formatter
 from argparse import Namespace
 from runner import __version__
 from runner.filetype import FileType
@@ -14,14 +20,125 @@ from runner.param import Param, MultiParam
 from runner.tools import parse_val
 #from runner.model.generic import get_or_make_filetype
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # default values
 ENV_OUT = "RUNDIR"
+MMAP_MIN_SIZE = 64*1024  # larger runner.json files are memory-mapped on read
 
 
 ParamIO = namedtuple("ParamIO", ["name","value"])
 
+_FORMATTER = Formatter()
+
+
+def _tolist(x):
+    return x.tolist() if hasattr(x, 'tolist') else x
+
+def _dumps(obj):
+    """indented JSON as bytes, with numpy arrays as lists
+
+    Always the json module: orjson would write NaN and Infinity as null.
+    """
+    return json.dumps(obj, indent=2, default=_tolist).encode('utf-8')
+
+def _loads(data):
+    """decode JSON bytes (orjson if available)
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass  # e.g. NaN, written by the json module
+    return json.loads(bytes(data) if isinstance(data, memoryview) else data)
+
+def _load_runfile(path):
+    """read and decode a JSON file, memory-mapped if large (with orjson, 
+    to avoid an intermediate copy of the file content)
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if orjson is None or size < MMAP_MIN_SIZE:
+            return _loads(f.read())
+        with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm)
+            try:
+                return _loads(view)
+            finally:
+                view.release()  # before the mmap is closed
+
+def _cpu_count():
+    """number of CPUs available to this process
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # not on all platforms
+        return os.cpu_count() or 1
+
+def _named_rundir(template):
+    """rename positional fields `{}` / `{0}` (run directory) as `{rundir}`
+    """
+    parts = []
+    for literal, field, spec, conversion in _FORMATTER.parse(template):
+        parts.append(literal.replace('{', '{{').replace('}', '}}'))
+        if field is None:
+            continue
+        if field == '' or field[0] in '.[':
+            field = 'rundir' + field
+        elif field == '0' or field[:2] in ('0.', '0['):
+            field = 'rundir' + field[1:]
+        parts.append('{' + field + ('!'+conversion if conversion else '') + (':'+spec if spec else '') + '}')
+    return ''.join(parts)
+
+def _class_path(cls):
+    return cls.__module__+'.'+cls.__name__
+
+def _import_class(path, base):
+    """import a class from its path, checking that it derives from `base`
+    """
+    module, name = path.rsplit('.', 1)
+    cls = getattr(import_module(module), name)
+    if not (isinstance(cls, type) and issubclass(cls, base)):
+        raise TypeError("{} is not a subclass of {}".format(path, base.__name__))
+    return cls
+
+def _check_init(cls, kwargs):
+    """check that cls can be re-created from kwargs (its saved attributes)
+    """
+    try:
+        inspect.signature(cls).bind(**kwargs)
+    except TypeError as error:
+        raise TypeError("cannot save {}: its attributes do not match its constructor arguments ({})".format(
+            _class_path(cls), error))
+
+def _filetype_to_dict(filetype):
+    """class path and constructor arguments (public attributes) of a file type
+    """
+    if filetype is None:
+        return None
+    if not isinstance(filetype, FileType):
+        raise TypeError("cannot save filetype: not a FileType instance: "+repr(filetype))
+    cls = type(filetype)
+    kwargs = {k:v for k,v in vars(filetype).items() if not k.startswith('_')}
+    _check_init(cls, kwargs)
+    return {'class': _class_path(cls), 'kwargs': kwargs}
+
+def _filetype_from_dict(cfg):
+    if cfg is None:
+        return None
+    return _import_class(cfg['class'], FileType)(**cfg['kwargs'])
+
 
 class ModelInterface(object):
+
+    # attributes saved by to_dict, in addition to the file types
+    _SERIALIZED = ('args', 'filename', 'filename_output', 
+                   'arg_out_prefix', 'arg_param_prefix', 'env_out', 'env_prefix', 
+                   'work_dir', 'defaults', 'setup_buffer_size')
+
     def __init__(self, args=None, 
                  filetype=None, filename=None, 
                  arg_out_prefix=None, arg_param_prefix=None, 
@@ -29,6 +146,7 @@ class ModelInterface(object):
                  work_dir=None, 
                  filetype_output=None, filename_output=None,
                  defaults=None,
+                 setup_buffer_size=65536,
                  ):
         """
         * args : [str] or str
@@ -54,8 +172,10 @@ class ModelInterface(object):
         * filename_output : relative path to rundir, optional
             filename for output variable (also needs filetype_output)
         * defaults : dict, optional, default parameters
+        * setup_buffer_size : int, optional
+            write buffer size (bytes) for the param file written by setup()
         """
-        if isinstance(args, six.string_types):
+        if isinstance(args, str):
             args = args.split()
         self.args = args or []
         self.filetype = filetype
@@ -68,6 +188,9 @@ class ModelInterface(object):
         self.env_out = env_out
         self.work_dir = work_dir or os.getcwd() 
         self.defaults = defaults or {}
+        self.setup_buffer_size = setup_buffer_size
+        self._exe_checked = {}  # {exe: ctime}, see _check_exe
+        self._frozen_args = None  # (args, templates), see _arg_templates
 
         # check !
         if filename:
@@ -77,6 +200,33 @@ class ModelInterface(object):
                 raise TypeError("invalid filetype: no `dumps` method: "+repr(filetype))
 
 
+    def to_dict(self):
+        """JSON-serializable description of the interface (see from_dict)
+
+        The interface class (for subclasses) and file types are stored as 
+        class path, file types with their public attributes, which must 
+        match their constructor arguments.
+        """
+        cfg = {k:getattr(self, k) for k in self._SERIALIZED}
+        cfg['filetype'] = _filetype_to_dict(self.filetype)
+        cfg['filetype_output'] = _filetype_to_dict(self.filetype_output)
+        _check_init(type(self), cfg)
+        cfg['class'] = _class_path(type(self))
+        return cfg
+
+    @classmethod
+    def from_dict(cls, cfg):
+        """create an interface from to_dict output, as an instance of the
+        saved class (which must be a subclass of `cls`)
+        """
+        cfg = dict(cfg)
+        path = cfg.pop('class', None)
+        if path is not None:
+            cls = _import_class(path, cls)
+        filetype = _filetype_from_dict(cfg.pop('filetype', None))
+        filetype_output = _filetype_from_dict(cfg.pop('filetype_output', None))
+        return cls(filetype=filetype, filetype_output=filetype_output, **cfg)
+
     def _command_out(self, rundir):
         if self.arg_out_prefix is None:
             return []
@@ -85,15 +235,42 @@ class ModelInterface(object):
     def _command_param(self, name, value):
         if self.arg_param_prefix is None:
             return []
-        prefix = self.arg_param_prefix.format(name, value)
-        return (prefix + str(value)).split()
+        return "{}{}".format(self.arg_param_prefix.format(name, value), value).split()
+
+    def _arg_templates(self):
+        """command arguments (after the executable) as format templates, 
+        parsed once, and again only if `self.args` was modified
+
+        `{{rundir}}` and positional `{}` are turned into `{rundir}`, 
+        for a single formatting pass with `format_map`.
+        """
+        frozen = self._frozen_args
+        if frozen is None or frozen[0] != self.args:
+            templates = tuple((_named_rundir(arg.replace('{{rundir}}', '{rundir}')), '{' in arg or '}' in arg)
+                              for arg in self.args[1:])
+            frozen = self._frozen_args = (list(self.args), templates)
+        return frozen[1]
+
+    def _format_args(self, rundir, params):
+        """format rundir and params with `{}`, `{NAME}` and `{{rundir}}`
+        """
+        kw = {**params, 'rundir': rundir}
+        return [arg.format_map(kw) if needs_format else arg
+                for arg, needs_format in self._arg_templates()]
 
-    def _format_args(self, rundir, **params):
-        """two-pass formatting: first rundir and params with `{}` and `{NAME}`
-        then `{{rundir}}`
+    def _check_exe(self, exe):
+        """check permissions of the model executable, once per file change
+        (ctime also changes with chmod)
         """
-        return [arg.format(rundir, **params).format(rundir=rundir) 
-                for arg in self.args[1:]]
+        try:
+            st = os.stat(exe)
+        except OSError:
+            return  # will fail at execution
+        if self._exe_checked.get(exe) == st.st_ctime_ns:
+            return
+        if stat.S_ISREG(st.st_mode) and not os.access(exe, os.X_OK):
+            raise ValueError("model executable is not : check permissions")
+        self._exe_checked[exe] = st.st_ctime_ns
 
     def command(self, rundir, params):
         if not self.args:
@@ -103,22 +280,25 @@ class ModelInterface(object):
 
         exe = self.args[0]
 
-        if os.path.isfile(exe):
-            if not os.access(exe, os.X_OK):
-                raise ValueError("model executable is not : check permissions")
+        # a bare name is looked up in PATH at execution
+        if os.sep in exe:
+            self._check_exe(exe)
 
-        args = [exe] 
-        args += self._command_out(rundir)
-        args += self._format_args(rundir, **params)
+        args = [exe, *self._command_out(rundir), *self._format_args(rundir, params)]
 
         # prepare modified command-line arguments with appropriate format
-        for name, value in params.items():
-            args += self._command_param(name, value)
+        # (single pass over params, templates above do not iterate them)
+        if self.arg_param_prefix is not None:
+            args.extend(token for name, value in params.items() 
+                        for token in self._command_param(name, value))
 
         return args
 
     def environ(self, rundir, params, env=None):
         """define environment variables to pass to model
+
+        Return a new dict (`env` updated with the parameters), or None
+        if there is nothing to pass (the model then inherits the environment)
         """
         if self.env_prefix is None:
             return None
@@ -133,11 +313,11 @@ class ModelInterface(object):
         update = {self.env_prefix+k:str(context[k])
                for k in context if context[k] is not None}
 
-        # update base environment
-        env = env or {}
-        env.update(update)
+        if not update:
+            return None
 
-        return env
+        # update base environment (without modifying it)
+        return {**(env or {}), **update}
 
     def workdir(self, rundir):
         """directory from which command is called, default to current (caller) directory (NOT rundir)
@@ -148,8 +328,15 @@ class ModelInterface(object):
     def runfile(self, rundir):
         return os.path.join(rundir, "runner.json")
 
-    def _write(self, rundir, runinfo, update=False):
+    def _read_runfile(self, runfile):
+        """read runner.json (see _load_runfile)
+        """
+        return _load_runfile(runfile)
 
+    def _write(self, rundir, runinfo, update=False, skip_time=False):
+        """write runinfo to runner.json (`update` existing content if True),
+        with a timestamp unless `skip_time` is True
+        """
         if not os.path.isdir(rundir):
             runfile = rundir
         else:
@@ -157,18 +344,20 @@ class ModelInterface(object):
 
         if update:
             updateinfo = runinfo
-            runinfo = json.load(open(runfile))
+            runinfo = self._read_runfile(runfile)
             runinfo.update(updateinfo)
 
         # add metadata
-        runinfo['time'] = str(datetime.datetime.now())
+        if not skip_time:
+            import datetime
+            runinfo['time'] = datetime.datetime.now().isoformat(timespec='seconds')
         runinfo['version'] = __version__
         runinfo['rundir'] = rundir
 
-        with open(runfile, 'w') as f:
-            json.dump(runinfo, f, 
-                      indent=2, 
-                      default=lambda x: x.tolist() if hasattr(x, 'tolist') else x)
+        # serialize in memory first: a single write call to disk
+        data = _dumps(runinfo)
+        with open(runfile, 'wb') as f:
+            f.write(data)
 
     def setup(self, rundir, params):
         """Write param file to run directory (assumed already created)
@@ -179,83 +368,90 @@ class ModelInterface(object):
             assert self.filetype
             #TODO: rename filename --> file_in OR file_param
             filepath = os.path.join(rundir, self.filename)
-            self.filetype.dump(params, open(filepath, 'w'))
+            with open(filepath, 'w', buffering=self.setup_buffer_size) as f:
+                self.filetype.dump(params, f)
             
 
     def postprocess(self, rundir):
         """return model output as dictionary or None
         """
         if not self.filename_output:
-            info = json.load(open(self.runfile(rundir)))
+            try:
+                info = self._read_runfile(self.runfile(rundir))
+            except FileNotFoundError:
+                return {}  # not written yet, unless by the model itself
             return info.pop("output", {})
 
         assert self.filetype_output, "filetype_output is required"
         return self.filetype_output.load(open(os.path.join(rundir, self.filename_output)))
 
 
-    def run(self, rundir, params, background=True, shell=False):
-        """Run the model
+    def _prepare(self, rundir, params, write_pre_run=False, shell=False):
+        """create run directory, write param file (and runner.json if 
+        write_pre_run is True)
 
-        Arguments:
-
-        * rundir : run directory
-        * params : dict of parameters (will be updated with default params)
-        * background : if False, no log file will be created
-        * shell : passed to subprocess
+        info['command'] is the command string: passed as is to the shell
+        if shell is True, otherwise quoted for the record.
 
-        Steps:
-
-        - create directory if not existing
-        - setup() : write param file if needed
-        - call subprocess or submit to SLURM
-        - postprocess() : read output
-        - write runner.json
+        Return args, workdir, env, info
         """
         # create run directory
-        if not os.path.exists(rundir):
-            os.makedirs(rundir)
+        os.makedirs(rundir, exist_ok=True)
 
-        params_kw = odict(self.defaults)
-        params_kw.update(params)
+        params_kw = {**self.defaults, **params}
 
         args = self.command(rundir, params_kw)
         workdir = self.workdir(rundir)
-        env = self.environ(rundir, params_kw, env=os.environ.copy())
+        # env=None: the model inherits the current environment as is,
+        # otherwise the current os.environ, updated with the parameters
+        env = None if self.env_prefix is None else self.environ(rundir, params_kw, env=os.environ)
 
         # also write parameters in a format runner understands, for the record
-        info = odict()
-        info['command'] = " ".join(args)
+        info = {}
+        info['command'] = " ".join(args) if shell else shlex.join(args)
         info['workdir'] = workdir
         info['env'] = env
         info['params'] = params_kw
         info['status'] = 'running'
-        self._write(rundir, info)
+        if write_pre_run:
+            self._write(rundir, info, skip_time=True)  # timestamp on completion
 
-        self.setup(rundir, params_kw)
+        try:
+            self.setup(rundir, params_kw)
+        except:
+            info['status'] = 'failed'
+            self._write(rundir, info)
+            raise
 
-        #print("Hello after setup.") 
+        return args, workdir, env, info
 
-        if background:
-            output = os.path.join(rundir, 'log.out')
-            error = os.path.join(rundir, 'log.err')
-            stdout = open(output, 'a+')
-            stderr = open(error, 'a+')
-        else:
-            stdout = None
-            stderr = None
+    @contextmanager
+    def _logs(self, rundir, background=True):
+        """log files (stdout, stderr) for the model, closed on exit
+        (the model process keeps its own file descriptors)
 
-        # wait for execution and postprocess
+        Only their descriptors are passed to the model, which writes to 
+        them directly: opened unbuffered in binary mode.
+        """
+        if not background:
+            yield None, None
+            return
+        with open(os.path.join(rundir, 'log.out'), 'ab', buffering=0) as stdout, \
+                open(os.path.join(rundir, 'log.err'), 'ab', buffering=0) as stderr:
+            yield stdout, stderr
+
+    @contextmanager
+    def _execute(self, rundir, workdir, info):
+        """wrap model execution: postprocess and update runner.json
+        """
         try:
-            if shell:
-                args = " ".join(args)
-            subprocess.check_call(args, env=env, cwd=workdir, 
-                                  stdout=stdout, stderr=stderr, shell=shell)
+            yield
             info['status'] = 'success'
-            info['output'] = output = self.postprocess(rundir)
+            info['output'] = self.postprocess(rundir)
 
         except OSError as error:
             info['status'] = 'failed'
-            raise OSError("FAILED TO EXECUTE: `"+" ".join(args)+"` FROM `"+workdir+"`")
+            raise OSError("FAILED TO EXECUTE: `"+info['command']+"` FROM `"+workdir+"`")
 
         except:
             info['status'] = 'failed'
@@ -264,7 +460,118 @@ class ModelInterface(object):
         finally:
             self._write(rundir, info)
 
-        return output
+    def run(self, rundir, params, background=True, shell=False, write_pre_run=False):
+        """Run the model
+
+        Arguments:
+
+        * rundir : run directory
+        * params : dict of parameters (will be updated with default params)
+        * background : if False, no log file will be created
+        * shell : passed to subprocess
+        * write_pre_run : if True, also write runner.json (status "running")
+            before the model starts, so that it exists even if the process
+            is killed. Otherwise it is written once, after completion.
+
+        Steps:
+
+        - create directory if not existing
+        - setup() : write param file if needed
+        - call subprocess or submit to SLURM
+        - postprocess() : read output
+        - write runner.json
+        """
+        args, workdir, env, info = self._prepare(rundir, params, write_pre_run, shell)
+
+        # wait for execution and postprocess
+        with self._logs(rundir, background) as (stdout, stderr), \
+                self._execute(rundir, workdir, info):
+            subprocess.check_call(info['command'] if shell else args, env=env, cwd=workdir, 
+                                  stdout=stdout, stderr=stderr, shell=shell)
+
+        return info['output']
+
+    async def run_async(self, rundir, params, background=True, shell=False, write_pre_run=False):
+        """Same as run, but as a coroutine, so that several model runs
+        can be awaited concurrently (see run_many)
+        """
+        args, workdir, env, info = self._prepare(rundir, params, write_pre_run, shell)
+
+        with self._logs(rundir, background) as (stdout, stderr), \
+                self._execute(rundir, workdir, info):
+            if shell:
+                cmd = info['command']
+                proc = await asyncio.create_subprocess_shell(cmd, env=env, cwd=workdir, 
+                                                             stdout=stdout, stderr=stderr)
+            else:
+                cmd = args
+                proc = await asyncio.create_subprocess_exec(*args, env=env, cwd=workdir, 
+                                                            stdout=stdout, stderr=stderr)
+            try:
+                returncode = await proc.wait()
+            except asyncio.CancelledError:
+                proc.kill()  # do not leave the model running unattended
+                await proc.wait()
+                raise
+            if returncode:
+                raise subprocess.CalledProcessError(returncode, cmd)
+
+        return info['output']
+
+    async def run_many(self, jobs, background=True, shell=False, write_pre_run=False):
+        """Run several models concurrently
+
+        * jobs : iterable of (rundir, params)
+        * background, shell, write_pre_run : see run
+
+        Return the list of outputs. All jobs are run, then the first
+        exception (if any) is raised.
+        """
+        results = await asyncio.gather(*[self.run_async(rundir, params, background=background, shell=shell,
+                                                        write_pre_run=write_pre_run)
+                                         for rundir, params in jobs], return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return results
+
+    async def run_pool(self, jobs, max_concurrency=None, background=True, shell=False, write_pre_run=False):
+        """Run several models, at most `max_concurrency` at a time
+
+        * jobs : iterable of (rundir, params)
+        * max_concurrency : int, optional
+            number of models running concurrently, by default the 
+            number of CPUs available to this process
+        * background, shell, write_pre_run : see run
+
+        Return the list of outputs, in the order of jobs. All jobs are 
+        run, then the first exception (if any) is raised.
+        """
+        if max_concurrency is None:
+            max_concurrency = _cpu_count()
+        elif max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1, got {}".format(max_concurrency))
+
+        queue = asyncio.Queue()
+        for i, job in enumerate(jobs):
+            queue.put_nowait((i, job))
+        results = [None]*queue.qsize()
+        errors = []
+        max_concurrency = min(max_concurrency, len(results))
+
+        async def worker():
+            while not queue.empty():
+                i, (rundir, params) = queue.get_nowait()
+                try:
+                    results[i] = await self.run_async(rundir, params, background=background, shell=shell,
+                                                      write_pre_run=write_pre_run)
+                except Exception as error:
+                    errors.append((i, error))
+
+        await asyncio.gather(*[worker() for _ in range(max_concurrency)])
+        if errors:
+            raise min(errors, key=lambda e: e[0])[1]
+        return results
 
 
     def __call__(self, rundir, params):
@@ -299,41 +606,34 @@ class Model(object):
 
 
     @classmethod
-    def files(cls, folder, prefix=""):
-        return (os.path.join(folder, prefix+'interface.pickle'),
-                os.path.join(folder, prefix+'prior.json'),
-                os.path.join(folder, prefix+'likelihood.json'))
+    def file(cls, folder, prefix=""):
+        return os.path.join(folder, prefix+'model.json')
 
     def write(self, folder, prefix="", force=False):
 
-        fi, fp, fl = self.files(folder, prefix)
-        for f in fi, fp, fl:
-            if os.path.exists(f) and not force:
-                raise IOError("Model.write: file already exists:"+f)
-
-        with open(fi,'w') as f:
-            pickle.dump(self.interface, f)
+        file = self.file(folder, prefix)
+        if os.path.exists(file) and not force:
+            raise IOError("Model.write: file already exists:"+file)
 
-        with open(fp,'w') as f:
-            json.dump({'prior':[p.as_dict() for p in self.prior]}, f)
-
-        with open(fl,'w') as f:
-            json.dump({'likelihood':[p.as_dict() for p in self.likelihood]}, f)
+        # serialize first: no partial file if the interface cannot be saved
+        data = _dumps({
+            'interface':self.interface.to_dict(),
+            'prior':[p.as_dict() for p in self.prior],
+            'likelihood':[p.as_dict() for p in self.likelihood],
+        })
+        with open(file,'wb') as f:
+            f.write(data)
 
 
     @classmethod
     def read(cls, folder, prefix=""):
 
-        fi, fp, fl = self.files(folder, prefix)
-
-        with open(fi) as f:
-            interface = pickle.load(f)
-
-        with open(fp) as f:
-            prior = [Param.fromkw(p) for p in json.load(f)['prior']]
+        with open(cls.file(folder, prefix), 'rb') as f:
+            cfg = _loads(f.read())
 
-        with open(fl) as f:
-            likelihood = [Param.fromkw(p) for p in json.load(f)['likelihood']]
+        interface = ModelInterface.from_dict(cfg['interface'])
+        prior = [Param.fromkw(**p) for p in cfg['prior']]
+        likelihood = [Param.fromkw(**p) for p in cfg['likelihood']]
 
         return cls(interface, prior, likelihood)
 
@@ -378,7 +678,14 @@ class FrozenModel(object):
 
     def load(self, file=None):
         " load model output + params from output directory "
-        cfg = json.load(open(file or self.runfile))
+        try:
+            cfg = self.model.interface._read_runfile(file or self.runfile)
+        except FileNotFoundError:
+            if file is not None:
+                raise
+            # run not started or interrupted (see ModelInterface.run's write_pre_run)
+            self.status = None
+            return self
         self.params = cfg["params"]
         self.output = cfg.pop("output",{})
         self.status = cfg.pop("status", None)
@@ -392,10 +699,11 @@ class FrozenModel(object):
         }, update=True)
 
 
-    def run(self, background=True, shell=False):
-        """Run the model
+    def run(self, background=True, shell=False, write_pre_run=False):
+        """Run the model (see ModelInterface.run)
         """
-        self.output = self.model.interface.run(self.rundir, self.params, background=background, shell=shell)
+        self.output = self.model.interface.run(self.rundir, self.params, background=background, shell=shell,
+                                               write_pre_run=write_pre_run)
         self.status = "success"
         return self
 
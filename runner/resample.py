@@ -190,12 +190,7 @@ def adaptive_posterior_exponent(likelihood, epsilon=None, neff_bounds=NEFF_BOUND
 def _build_ids(counts):
     """ make an array of ids from counts, e.g. [3, 0, 1] will returns [0, 0, 0, 2]
     """
-    ids = np.empty(counts.sum(), dtype=int)
-    start = 0
-    for i, count in enumerate(counts):
-        ids[start:start+count] = i
-        start += count
-    return ids
+    return np.repeat(np.arange(counts.size), counts)
 
 def multinomial_resampling(weights, size):
     """
@@ -309,7 +304,7 @@ class Resampler(object):
         np.random.seed(seed) # random state
         if method == 'residual':
             ids = self.sample_residual(size)
-        elif method == 'residual':
+        elif method == 'multinomial':
             ids = self.sample_multinomal(size)
         elif method in ("stratified", "deterministic"):
             raise NotImplementedError(method) # todo
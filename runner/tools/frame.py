@@ -46,13 +46,13 @@ def str_dataframe(pnames, pmatrix, max_rows=1e20, include_index=False, index=Non
 
 def read_dataframe(pfile):
     import numpy as np
-    header = open(pfile).readline().strip()
-    if header.startswith('#'):
-        header = header[1:]
-    pnames = header.split()
-    pvalues = np.loadtxt(pfile, skiprows=1)  
-    if np.ndim(pvalues) == 1:
-        pvalues = pvalues[:, None]
+    with open(pfile) as f:
+        header = f.readline().strip()
+        if header.startswith('#'):
+            header = header[1:]
+        pnames = header.split()
+        # rest of the file, header already consumed
+        pvalues = np.loadtxt(f, ndmin=2)
     return pnames, pvalues
 
 
@@ -8,5 +8,6 @@ setup(name='runner',
       author_email='mahe.perrette@pik-potsdam.de',
       packages = ['runner', 'runner.lib', 'runner.ext', 'runner.tools', 'runner.job'],
       install_requires = ['numpy', 'pandas', 'scipy', 'six', 'tox','tabulate'],
+      python_requires = '>=3.8',
       scripts = ['scripts/job','scripts/jobrun'], 
       )
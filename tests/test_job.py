@@ -193,6 +193,12 @@ class TestRunSubmit(TestRunBase):
 --a 4 --b 1 --out out/5
                          """.strip())
 
+    def test_write_pre_run(self):
+        _ = getoutput(JOB+' run -p a=2,3 -o out --write-pre-run -- cat {}/runner.json')
+        for i in range(2):
+            self.assertEqual(json.load(open('out/{}/log.out'.format(i)))['status'], 'running')
+            self.assertEqual(json.load(open('out/{}/runner.json'.format(i)))['status'], 'success')
+
 
 class TestRunIndices(TestRunBase):
 
@@ -0,0 +1,208 @@
+from __future__ import absolute_import
+import unittest
+import os, shutil
+import json
+import asyncio
+import tempfile
+import math
+import subprocess
+import time
+from utils import runner
+
+from runner.model import ModelInterface, Model
+from runner.filetype import FileType, JsonFile, LineSeparator
+from runner.param import Param
+
+
+class TestRunAsync(unittest.TestCase):
+
+    def setUp(self):
+        if os.path.exists('out'):
+            raise RuntimeError('remove output directory `out` before running run tests')
+
+    def tearDown(self):
+        if os.path.exists('out'):
+            shutil.rmtree('out')
+
+    def test_run_many(self):
+        model = ModelInterface('cp {}/params.json {}/output.json',
+                               filetype=JsonFile(), filename='params.json',
+                               filetype_output=JsonFile(), filename_output='output.json')
+        jobs = [('out/0', {'a': 0}), ('out/1', {'a': 1})]
+        outputs = asyncio.run(model.run_many(jobs))
+        self.assertEqual(outputs, [{'a': 0}, {'a': 1}])
+        self.assertEqual(json.load(open('out/1/runner.json'))['status'], 'success')
+
+    def test_run_many_failed(self):
+        model = ModelInterface(['sh', '-c', '{script}'])
+        jobs = [('out/0', {'script': 'exit 1'}), 
+                ('out/1', {'script': 'sleep 1; touch out/1/flag'})]
+        with self.assertRaises(subprocess.CalledProcessError):
+            asyncio.run(model.run_many(jobs))
+        self.assertEqual(json.load(open('out/0/runner.json'))['status'], 'failed')
+        self.assertEqual(json.load(open('out/1/runner.json'))['status'], 'success')
+        self.assertTrue(os.path.exists('out/1/flag'))
+
+    def test_run_async_cancelled(self):
+        model = ModelInterface(['sh', '-c', '{script}'])
+        async def cancel():
+            task = asyncio.ensure_future(model.run_async('out/0', {'script': 'sleep 1; touch out/0/flag'}))
+            await asyncio.sleep(0.2)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+        asyncio.run(cancel())
+        time.sleep(1.5)
+        self.assertFalse(os.path.exists('out/0/flag'))
+        self.assertEqual(json.load(open('out/0/runner.json'))['status'], 'failed')
+
+    def test_write_pre_run(self):
+        model = ModelInterface(['sh', '-c', '{script}'])
+        script = 'cp out/0/runner.json out/0/pre.json'
+        asyncio.run(model.run_many([('out/0', {'script': script})], write_pre_run=True))
+        self.assertEqual(json.load(open('out/0/pre.json'))['status'], 'running')
+        self.assertEqual(json.load(open('out/0/runner.json'))['status'], 'success')
+
+    def test_run_pool(self):
+        model = ModelInterface('cp {}/params.json {}/output.json',
+                               filetype=JsonFile(), filename='params.json',
+                               filetype_output=JsonFile(), filename_output='output.json')
+        jobs = [('out/{}'.format(i), {'a': i}) for i in range(5)]
+        outputs = asyncio.run(model.run_pool(jobs, max_concurrency=2))
+        self.assertEqual(outputs, [{'a': i} for i in range(5)])
+
+    def test_run_pool_invalid(self):
+        model = ModelInterface()
+        with self.assertRaises(ValueError):
+            asyncio.run(model.run_pool([('out/0', {})], max_concurrency=0))
+        self.assertFalse(os.path.exists('out'))
+
+    def test_run_async_failed(self):
+        model = ModelInterface('false')
+        with self.assertRaises(Exception):
+            asyncio.run(model.run_async('out/0', {}))
+        self.assertEqual(json.load(open('out/0/runner.json'))['status'], 'failed')
+
+
+class TestRunInfo(unittest.TestCase):
+
+    def setUp(self):
+        if os.path.exists('out'):
+            raise RuntimeError('remove output directory `out` before running run tests')
+
+    def tearDown(self):
+        if os.path.exists('out'):
+            shutil.rmtree('out')
+
+    def test_nan_output(self):
+        model = ModelInterface('cp {}/params.json {}/output.json',
+                               filetype=JsonFile(), filename='params.json',
+                               filetype_output=JsonFile(), filename_output='output.json')
+        model.run('out/0', {'a': float('nan'), 'b': float('inf')})
+        output = ModelInterface()._read_runfile('out/0/runner.json')['output']
+        self.assertTrue(math.isnan(output['a']))
+        self.assertEqual(output['b'], float('inf'))
+
+    def test_read_runfile_copy(self):
+        model = ModelInterface()
+        model.run('out/0', {'a': 1})
+        model.run('out/1', {'a': 2})
+        info = model._read_runfile('out/0/runner.json')
+        info['params']['a'] = 3
+        self.assertEqual(model._read_runfile('out/0/runner.json')['params'], {'a': 1})
+        self.assertEqual(model._read_runfile('out/1/runner.json')['params'], {'a': 2})
+
+    def test_environ_current(self):
+        model = ModelInterface('cp {}/params.json {}/output.json', env_prefix='RUNNER_',
+                               filetype=JsonFile(), filename='params.json')
+        os.environ['RUNNER_TEST_VAR'] = 'x'
+        try:
+            model.run('out/0', {'a': 1})
+        finally:
+            del os.environ['RUNNER_TEST_VAR']
+        env = model._read_runfile('out/0/runner.json')['env']
+        self.assertEqual((env['RUNNER_TEST_VAR'], env['RUNNER_a']), ('x', '1'))
+
+
+class TestCommand(unittest.TestCase):
+
+    def test_format(self):
+        model = ModelInterface('exe --out {} --a={a} {{rundir}}/f', arg_param_prefix='--{}=')
+        self.assertEqual(model.command('out/0', {'a': 1}),
+                         ['exe', '--out', 'out/0', '--a=1', 'out/0/f', '--a=1'])
+
+    def test_args_extended(self):
+        model = ModelInterface('exe {}')
+        model.command('out/0', {})
+        model.args.extend(['--b', '{b}'])
+        self.assertEqual(model.command('out/0', {'b': 2}), ['exe', 'out/0', '--b', '2'])
+
+    def test_check_exe(self):
+        with tempfile.TemporaryDirectory() as folder:
+            exe = os.path.join(folder, 'model.sh')
+            with open(exe, 'w') as f:
+                f.write('#!/bin/sh\n')
+            model = ModelInterface(exe)
+            os.chmod(exe, 0o644)
+            with self.assertRaises(ValueError):
+                model.command('out/0', {})
+            os.chmod(exe, 0o755)
+            self.assertEqual(model.command('out/0', {}), [exe])
+            self.assertEqual(model.command('out/0', {}), [exe])  # cached
+            os.chmod(exe, 0o644)  # ctime changes, not mtime
+            with self.assertRaises(ValueError):
+                model.command('out/0', {})
+
+
+class CustomInterface(ModelInterface):
+    def postprocess(self, rundir):
+        return {'custom': True}
+
+
+class TestModelIO(unittest.TestCase):
+
+    def test_write_read(self):
+        interface = ModelInterface('echo {}', filetype=LineSeparator('='), filename='params.txt',
+                                   arg_param_prefix='--{}=', defaults={'a': 1})
+        model = Model(interface, prior=[Param.parse('a=N?0,1')], likelihood=[Param.parse('b=U?0,2')])
+        with tempfile.TemporaryDirectory() as folder:
+            model.write(folder)
+            model2 = Model.read(folder)
+        self.assertEqual(model2.interface.to_dict(), interface.to_dict())
+        self.assertIsInstance(model2.interface.filetype, LineSeparator)
+        self.assertEqual([str(p) for p in model2.prior], [str(p) for p in model.prior])
+        self.assertEqual([str(p) for p in model2.likelihood], [str(p) for p in model.likelihood])
+
+    def test_write_read_subclass(self):
+        model = Model(CustomInterface('echo'))
+        with tempfile.TemporaryDirectory() as folder:
+            model.write(folder)
+            model2 = Model.read(folder)
+        self.assertIsInstance(model2.interface, CustomInterface)
+
+    def test_write_bad_init(self):
+        class BadInterface(ModelInterface):
+            def __init__(self, command):
+                super().__init__(command)
+        with tempfile.TemporaryDirectory() as folder:
+            with self.assertRaises(TypeError):
+                Model(BadInterface('echo')).write(folder)
+            self.assertFalse(os.path.exists(Model.file(folder)))
+
+    def test_write_bad_filetype(self):
+        class BadFile(FileType):
+            def __init__(self, sep):
+                self.separator = sep
+        with self.assertRaises(TypeError):
+            ModelInterface('echo', filetype=BadFile(' '), filename='params.txt').to_dict()
+
+    def test_read_not_filetype(self):
+        cfg = ModelInterface('echo').to_dict()
+        cfg['filetype'] = {'class': 'subprocess.Popen', 'kwargs': {'args': ['touch', 'flag']}}
+        with self.assertRaises(TypeError):
+            ModelInterface.from_dict(cfg)
+        self.assertFalse(os.path.exists('flag'))
+
+
+if __name__ == '__main__':
+    unittest.main()
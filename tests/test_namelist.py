@@ -0,0 +1,117 @@
+from __future__ import absolute_import
+import unittest
+import numpy as np
+import os
+import tempfile
+from utils import runner
+
+from runner.ext.namelist import Namelist, parse_nml, _load_nml_cached, _load_nml_keys, param_write_to_files
+
+
+class TestParseNml(unittest.TestCase):
+
+    string = """
+! leading comment / with slash
+&grp1
+  a = 1,
+  b = 2.5   ! help for b
+
+    ! inner comment
+  c = .true.
+  k = 1.0, 2.0,
+      3.0
+/
+
+&grp2
+  d = 'hello'
+/
+"""
+
+    def test_parse(self):
+        params = [(p.group, p.name, p.value, p.help) for p in parse_nml(self.string)]
+        self.assertEqual(params, [
+            ('grp1', 'a', 1, ''),
+            ('grp1', 'b', 2.5, 'help for b'),
+            ('grp1', 'c', True, ''),
+            ('grp1', 'k', [1.0, 2.0, 3.0], ''),
+            ('grp2', 'd', 'hello', ''),
+        ])
+
+    def test_ignore_comments(self):
+        params = parse_nml(self.string, ignore_comments=True)
+        self.assertEqual([p.help for p in params], ['']*5)
+
+    def test_crlf(self):
+        params = parse_nml("&g\r\n a = 1\r\n\r\n b = 2\r\n/\r\n")
+        self.assertEqual([(p.name, p.value) for p in params], [('a', 1), ('b', 2)])
+
+    def test_arrays(self):
+        params = Namelist().loads("&g\n a = 3*4\n b = 1 2 3\n c = 'x', 'y'\n d = /1,2/\n/\n")
+        self.assertEqual(list(params.values()), [[4, 4, 4], [1, 2, 3], ['x', 'y'], [1, 2]])
+
+    def test_keys(self):
+        nml = Namelist()
+        self.assertEqual(nml.loads_keys(self.string), list(nml.loads(self.string)))
+
+    def test_dumps_unsorted_groups(self):
+        string = Namelist().dumps({'g1.a': 1, 'g2.b': 2, 'g1.c': 3})
+        self.assertEqual([line.split()[0] for line in string.splitlines()],
+                         ['&g1', 'a', 'c', '/', '&g2', 'b', '/'])
+
+    def test_dumps_numpy(self):
+        string = Namelist().dumps({'g.a': np.float64(0.5), 'g.b': np.int64(2), 'g.c': np.bool_(True)})
+        self.assertEqual([line.split() for line in string.splitlines()[1:-1]],
+                         [['a', '=', '0.5'], ['b', '=', '2'], ['c', '=', '.true.']])
+
+    def test_roundtrip(self):
+        params = Namelist().loads(self.string)
+        self.assertEqual(Namelist().loads(Namelist().dumps(params)), params)
+
+
+class TestLoadCached(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.nml')
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def write(self, string, mtime=0):
+        with open(self.path, 'w') as f:
+            f.write(string)
+        os.utime(self.path, ns=(mtime, mtime))  # same timestamp for every write
+
+    def test_modified(self):
+        self.write("&g\n a = 1\n/\n")
+        self.assertEqual(_load_nml_cached(self.path), {'g.a': 1})
+        self.write("&g\n a = 22\n b = 3\n/\n")
+        self.assertEqual(_load_nml_cached(self.path), {'g.a': 22, 'g.b': 3})
+        self.assertEqual(_load_nml_keys(self.path), ['g.a', 'g.b'])
+
+    def test_copy(self):
+        self.write("&g\n a = 1\n k = 1 2\n/\n")
+        params = _load_nml_cached(self.path)
+        params['g.a'] = 2
+        params['g.k'].append(3)
+        self.assertEqual(_load_nml_cached(self.path), {'g.a': 1, 'g.k': [1, 2]})
+
+
+class TestWriteToFiles(unittest.TestCase):
+
+    def test_process_pool(self):
+        with tempfile.TemporaryDirectory() as folder:
+            src = [os.path.join(folder, 'src{}.nml'.format(i)) for i in range(3)]
+            dst = [os.path.join(folder, 'dst{}.nml'.format(i)) for i in range(3)]
+            for i, path in enumerate(src):
+                with open(path, 'w') as f:
+                    f.write("&g{}\n a = 1\n b = 2\n/\n".format(i))
+            param_write_to_files({'g0.a': 10, 'g2.b': 20}, src, dst, max_workers=2)
+            written = [_load_nml_cached(path) for path in dst]
+        self.assertEqual(written, [{'g0.a': 10, 'g0.b': 2}, 
+                                   {'g1.a': 1, 'g1.b': 2}, 
+                                   {'g2.a': 1, 'g2.b': 20}])
+
+
+if __name__ == '__main__':
+    unittest.main()